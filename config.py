@@ -16,14 +16,25 @@ class Settings:
     # RAG retrieval settings
     RAG_TOP_K: int = 5  # Number of chunks to retrieve (increased from 3)
     
+    # Semantic answer cache: reuse answers for near-duplicate questions
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92  # Minimum cosine similarity for a hit
+    SEMANTIC_CACHE_SIZE: int = 1024  # Max cached answers per document (LRU)
+    
     # Embedding model
     EMBEDDING_MODEL: str = "text-embedding-3-large"
+    EMBED_BATCH_SIZE: int = 64  # Chunks per embedding request; batches are sent concurrently
+    EMBED_CONCURRENCY: int = 16  # Max embedding requests in flight at once
+    EMBED_CACHE_PATH: str = os.getenv(
+        "EMBED_CACHE_PATH", os.path.join(CHROMA_PERSIST_DIR, "embed_cache.sqlite")
+    )  # Persistent text-hash -> vector cache
+    EMBED_CACHE_MAX_ENTRIES: int = 50_000  # Oldest entries pruned past this (~12 KB each at 3072 dims)
     
     # Chat model
     CHAT_MODEL: str = "gpt-4o-mini"
     
     # ChromaDB collection name
     COLLECTION_NAME: str = "pdf_documents"
+    CHROMA_BATCH_SIZE: int = 250  # Max records per collection.add call
 
 
 settings = Settings()
@@ -1,39 +1,92 @@
-from pathlib import Path
-from contextlib import asynccontextmanager
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing, asynccontextmanager
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from typing import List, Optional
 
-from services.document_service import document_service
+from config import settings
+from services.document_service import UnsupportedContentError, document_service
 from services.embedding_service import embedding_service
 from services.vector_store_service import vector_store_service
 from services.rag_service import rag_service
+from services.semantic_cache import semantic_cache
 from services.interpreter_service import interpreter_service
 from services.chat_service import chat_service
+from services.openai_client import async_openai_client
+
+
+logger = logging.getLogger("cortexa")
+
+# PDF parsing and chunking is CPU-bound; run it in worker processes so it
+# neither blocks the event loop nor contends for the GIL. Workers must not be
+# forked from this process: it already runs threads (aiosqlite, to_thread,
+# Chroma) whose locks a fork could copy mid-acquire.
+_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+EXTRACT_POOL = ProcessPoolExecutor(
+    max_workers=os.cpu_count(),
+    mp_context=multiprocessing.get_context(_START_METHOD)
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Initialize services on startup."""
+    """Initialize services on startup and release them on shutdown."""
+    logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
+    vector_store_service.initialize()
     await chat_service.initialize()
     yield
+    await chat_service.close()
+    await async_openai_client.close()
+    EXTRACT_POOL.shutdown(cancel_futures=True)
+
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
 
+def _run_in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-app = FastAPI(title="Cortexa - Document Interpretation", version="1.0.0", lifespan=lifespan)
+
+async def _prefetch_for_session(doc_id: str) -> None:
+    """Warm the document's vectors and the OpenAI connection ahead of the next /ask."""
+    try:
+        await asyncio.gather(
+            asyncio.to_thread(vector_store_service.warm_doc, doc_id),
+            async_openai_client.models.retrieve(settings.CHAT_MODEL)
+        )
+    except Exception:
+        # Best effort; the next /ask simply runs cold
+        logger.debug("Session prefetch failed for %s", doc_id, exc_info=True)
+
+
+app = FastAPI(
+    title="Cortexa - Document Interpretation",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # CORS middleware for frontend
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://localhost:3001", "http://localhost:3002", "http://localhost:3003"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PATCH", "DELETE"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,  # Let browsers cache preflight results for 24h
 )
 
-ALLOWED_EXTENSIONS = {'.pdf', '.txt', '.md'}
+ALLOWED_EXTENSIONS = frozenset({"pdf", "txt", "md"})
 
 
 class UploadResponse(BaseModel):
@@ -49,6 +102,8 @@ class AskRequest(BaseModel):
 
 
 class Citation(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     text: str
     page: int
     confidence: float
@@ -87,6 +142,8 @@ class CreateSessionRequest(BaseModel):
 
 
 class ChatSession(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     id: str
     doc_id: str
     title: str
@@ -95,6 +152,8 @@ class ChatSession(BaseModel):
 
 
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     id: str
     session_id: str
     role: str
@@ -107,6 +166,12 @@ class ChatSessionWithMessages(ChatSession):
     messages: List[ChatMessage] = []
 
 
+# Validate lists in a single call instead of one model __init__ per item
+CITATIONS_ADAPTER = TypeAdapter(List[Citation])
+SESSIONS_ADAPTER = TypeAdapter(List[ChatSession])
+MESSAGES_ADAPTER = TypeAdapter(List[ChatMessage])
+
+
 class AddMessageRequest(BaseModel):
     role: str
     content: str
@@ -122,17 +187,18 @@ async def list_documents():
     """List all documents stored in the database."""
     try:
         docs = vector_store_service.get_all_documents()
-        result = []
-        for doc in docs:
-            filename = document_service.get_filename_by_doc_id(doc["doc_id"])
-            result.append(DocumentInfo(
+        filenames = document_service.get_filenames_bulk([doc["doc_id"] for doc in docs])
+        return [
+            DocumentInfo(
                 doc_id=doc["doc_id"],
-                filename=filename or "Unknown",
+                filename=filenames.get(doc["doc_id"], "Unknown"),
                 chunks=doc["chunks"]
-            ))
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error listing documents: {str(e)}")
+            )
+            for doc in docs
+        ]
+    except Exception:
+        logger.exception("list_documents failed")
+        raise HTTPException(status_code=500, detail="Error listing documents")
 
 
 @app.delete("/documents/{doc_id}")
@@ -142,13 +208,24 @@ async def delete_document(doc_id: str):
         if not vector_store_service.document_exists(doc_id):
             raise HTTPException(status_code=404, detail="Document not found")
         
-        vector_store_service.delete_document(doc_id)
-        document_service.delete_document_file(doc_id)
+        await asyncio.to_thread(vector_store_service.delete_document, doc_id)
+        await asyncio.to_thread(document_service.delete_document_file, doc_id)
+        semantic_cache.invalidate(doc_id)
         return {"status": "deleted", "doc_id": doc_id}
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
+    except Exception:
+        logger.exception("delete_document failed")
+        raise HTTPException(status_code=500, detail="Error deleting document")
+
+
+async def _discard_upload(doc_id: str) -> None:
+    """Remove the file and any chunks a failed upload already stored, so it is never listed half-indexed."""
+    try:
+        await asyncio.to_thread(vector_store_service.delete_document, doc_id)
+        await asyncio.to_thread(document_service.delete_document_file, doc_id)
+    except Exception:
+        logger.exception("Cleaning up failed upload %s failed", doc_id)
 
 
 @app.post("/upload", response_model=UploadResponse)
@@ -156,21 +233,32 @@ async def upload_document(file: UploadFile = File(...)):
     """
     Upload a document (pdf, txt, md), extract text, chunk it, generate embeddings, and store in ChromaDB.
     """
-    ext = Path(file.filename).suffix.lower()
-    if ext not in ALLOWED_EXTENSIONS:
-        raise HTTPException(status_code=400, detail=f"Supported formats: {', '.join(ALLOWED_EXTENSIONS)}")
+    _, dot, ext = file.filename.rpartition(".")
+    if not dot or ext.lower() not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Supported formats: pdf, txt, md")
 
     try:
-        file_content = await file.read()
-        doc_id, file_path = document_service.save_document(file_content, file.filename)
-        chunks = document_service.extract_and_chunk_text(file_path)
-
-        if not chunks:
-            raise HTTPException(status_code=400, detail="No text could be extracted from the document")
-
-        chunk_texts = [chunk["text"] for chunk in chunks]
-        embeddings = embedding_service.generate_embeddings(chunk_texts)
-        vector_store_service.add_chunks(doc_id, chunks, embeddings)
+        doc_id, file_path = await document_service.save_document(file, file.filename)
+        try:
+            chunks = await document_service.aextract_and_chunk(file_path, EXTRACT_POOL)
+
+            if not chunks:
+                raise HTTPException(status_code=400, detail="No text could be extracted from the document")
+
+            # Insert each window into Chroma while later embedding requests are in
+            # flight; aclosing cancels those requests as soon as anything fails
+            window = settings.CHROMA_BATCH_SIZE
+            async with aclosing(embedding_service.aiter_chunk_embeddings(
+                [chunk["text"] for chunk in chunks], window
+            )) as windows:
+                async for start, embeddings in windows:
+                    await asyncio.to_thread(
+                        vector_store_service.add_chunks,
+                        doc_id, chunks[start:start + window], embeddings, start
+                    )
+        except BaseException:
+            await _discard_upload(doc_id)
+            raise
 
         return UploadResponse(
             doc_id=doc_id,
@@ -178,8 +266,15 @@ async def upload_document(file: UploadFile = File(...)):
             chunks_created=len(chunks)
         )
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
+    except HTTPException:
+        raise
+    except UnsupportedContentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Text files must be UTF-8 encoded")
+    except Exception:
+        logger.exception("upload_document failed")
+        raise HTTPException(status_code=500, detail="Error processing document")
 
 
 @app.post("/ask", response_model=AskResponse)
@@ -194,7 +289,14 @@ async def ask_question(request: AskRequest):
         AskResponse with answer and citations
     """
     try:
-        result = rag_service.answer_question(request.question, request.doc_id)
+        # Reuse the answer to a near-duplicate question when one is cached
+        question_embedding = await embedding_service.agenerate_embedding(request.question)
+        result = semantic_cache.lookup(request.doc_id, question_embedding)
+        if result is None:
+            result = await rag_service.aanswer_question(
+                request.question, request.doc_id, question_embedding=question_embedding
+            )
+            semantic_cache.store(request.doc_id, question_embedding, result)
         
         # Auto-save to session if session_id provided
         if request.session_id:
@@ -214,18 +316,19 @@ async def ask_question(request: AskRequest):
         
         return AskResponse(
             answer=result["answer"],
-            citations=[Citation(**c) for c in result["citations"]]
+            citations=CITATIONS_ADAPTER.validate_python(result["citations"])
         )
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error answering question: {str(e)}")
+    except Exception:
+        logger.exception("ask_question failed")
+        raise HTTPException(status_code=500, detail="Error answering question")
 
 
 @app.post("/interpret", response_model=InterpretResponse)
 async def interpret_input(request: InterpretRequest):
     """Interpret user input with specified tone and style."""
     try:
-        result = interpreter_service.interpret(
+        result = await interpreter_service.ainterpret(
             user_input=request.input,
             tone=request.tone,
             style=request.style,
@@ -233,8 +336,9 @@ async def interpret_input(request: InterpretRequest):
         )
         return InterpretResponse(**result)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error interpreting input: {str(e)}")
+    except Exception:
+        logger.exception("interpret_input failed")
+        raise HTTPException(status_code=500, detail="Error interpreting input")
 
 
 # ==================== Chat Session Endpoints ====================
@@ -244,9 +348,10 @@ async def list_sessions(doc_id: Optional[str] = Query(None)):
     """List all chat sessions, optionally filtered by document ID."""
     try:
         sessions = await chat_service.get_sessions(doc_id)
-        return [ChatSession(**s) for s in sessions]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error listing sessions: {str(e)}")
+        return SESSIONS_ADAPTER.validate_python(sessions)
+    except Exception:
+        logger.exception("list_sessions failed")
+        raise HTTPException(status_code=500, detail="Error listing sessions")
 
 
 @app.post("/sessions", response_model=ChatSession)
@@ -255,8 +360,9 @@ async def create_session(request: CreateSessionRequest):
     try:
         session = await chat_service.create_session(request.doc_id, request.title)
         return ChatSession(**session)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error creating session: {str(e)}")
+    except Exception:
+        logger.exception("create_session failed")
+        raise HTTPException(status_code=500, detail="Error creating session")
 
 
 @app.get("/sessions/{session_id}", response_model=ChatSessionWithMessages)
@@ -267,17 +373,14 @@ async def get_session(session_id: str):
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Convert messages to proper format
-        messages = []
-        for msg in session.get("messages", []):
-            messages.append(ChatMessage(
-                id=msg["id"],
-                session_id=msg["session_id"],
-                role=msg["role"],
-                content=msg["content"],
-                citations=[Citation(**c) for c in msg.get("citations", [])] if msg.get("citations") else None,
-                created_at=msg["created_at"]
-            ))
+        # Opening a chat is usually followed by a question about the same document
+        _run_in_background(_prefetch_for_session(session["doc_id"]))
+        
+        # Messages without citations are reported as null rather than []
+        messages = session.get("messages", [])
+        for msg in messages:
+            if not msg.get("citations"):
+                msg["citations"] = None
         
         return ChatSessionWithMessages(
             id=session["id"],
@@ -285,12 +388,13 @@ async def get_session(session_id: str):
             title=session["title"],
             created_at=session["created_at"],
             updated_at=session["updated_at"],
-            messages=messages
+            messages=MESSAGES_ADAPTER.validate_python(messages)
         )
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting session: {str(e)}")
+    except Exception:
+        logger.exception("get_session failed")
+        raise HTTPException(status_code=500, detail="Error getting session")
 
 
 @app.patch("/sessions/{session_id}", response_model=ChatSession)
@@ -306,8 +410,9 @@ async def update_session(session_id: str, request: UpdateSessionRequest):
         return ChatSession(**updated_session)
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error updating session: {str(e)}")
+    except Exception:
+        logger.exception("update_session failed")
+        raise HTTPException(status_code=500, detail="Error updating session")
 
 
 @app.delete("/sessions/{session_id}")
@@ -320,8 +425,9 @@ async def delete_session(session_id: str):
         return {"status": "deleted", "session_id": session_id}
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error deleting session: {str(e)}")
+    except Exception:
+        logger.exception("delete_session failed")
+        raise HTTPException(status_code=500, detail="Error deleting session")
 
 
 @app.post("/sessions/{session_id}/messages", response_model=ChatMessage)
@@ -344,13 +450,14 @@ async def add_message(session_id: str, request: AddMessageRequest):
             session_id=message["session_id"],
             role=message["role"],
             content=message["content"],
-            citations=[Citation(**c) for c in message.get("citations", [])] if message.get("citations") else None,
+            citations=CITATIONS_ADAPTER.validate_python(message["citations"]) if message.get("citations") else None,
             created_at=message["created_at"]
         )
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error adding message: {str(e)}")
+    except Exception:
+        logger.exception("add_message failed")
+        raise HTTPException(status_code=500, detail="Error adding message")
 
 
 @app.get("/sessions/{session_id}/export")
@@ -362,27 +469,22 @@ async def export_session(session_id: str, format: str = Query("md", pattern="^(m
             raise HTTPException(status_code=404, detail="Session not found")
         
         if format == "md":
-            content = await chat_service.export_markdown(session_id)
-            if not content:
-                raise HTTPException(status_code=500, detail="Error generating markdown")
-            return Response(
-                content=content,
+            return StreamingResponse(
+                chat_service.stream_markdown(session_id),
                 media_type="text/markdown",
                 headers={"Content-Disposition": f"attachment; filename={session['title']}.md"}
             )
         else:  # pdf
-            content = await chat_service.export_pdf(session_id)
-            if not content:
-                raise HTTPException(status_code=500, detail="Error generating PDF")
-            return Response(
-                content=content,
+            return StreamingResponse(
+                chat_service.stream_pdf(session_id),
                 media_type="application/pdf",
                 headers={"Content-Disposition": f"attachment; filename={session['title']}.pdf"}
             )
     except HTTPException:
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error exporting session: {str(e)}")
+    except Exception:
+        logger.exception("export_session failed")
+        raise HTTPException(status_code=500, detail="Error exporting session")
 
 
 @app.get("/health")
@@ -392,5 +494,15 @@ async def health_check():
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Single worker: Chroma's PersistentClient and the in-process caches
+    # are not shared across processes.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        lifespan="on"
+    )
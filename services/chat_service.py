@@ -2,30 +2,167 @@
 Chat service for session management, message handling, and export functionality.
 """
 
-import json
+import asyncio
+import logging
+import secrets
+import tempfile
+import threading
+import time
 import uuid
-from io import BytesIO
-from typing import Optional
+from collections import OrderedDict
+from datetime import datetime
+from io import StringIO
+from typing import AsyncIterator, BinaryIO, Iterator, Optional
+import orjson
+# fpdf2 (not the legacy PyFPDF package, which shares the import name): it
+# accumulates output in a bytearray, avoiding O(n^2) str concatenation in _out
 from fpdf import FPDF
 
 from services.database_service import database_service
 
+logger = logging.getLogger("cortexa")
+
+# Write-behind settings for message inserts
+WRITE_INTERVAL_SECONDS = 0.05
+WRITE_RETRY_SECONDS = 1.0
+WRITE_BATCH_SIZE = 256
+WRITE_QUEUE_SIZE = 4096
+
+# Size of each chunk yielded by streaming exports
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Messages loaded and laid out per step of a PDF export
+EXPORT_MESSAGE_BATCH = 500
+
+# Latin-1-safe message contents kept for re-exports (messages are immutable)
+SAFE_CONTENT_CACHE_SIZE = 4096
+
+# Last (millisecond, sequence) pair handed out by _time_ordered_id
+_last_id_tick = (0, 0)
+
+
+def _time_ordered_id() -> str:
+    """
+    Generate a UUIDv7 as 32 hex chars: a 48-bit millisecond timestamp, a
+    12-bit sequence, then random bits.
+
+    IDs increase monotonically within the process, so new rows append to the
+    end of the primary-key B-tree instead of landing on random pages.
+    """
+    global _last_id_tick
+    ms = time.time_ns() // 1_000_000
+    last_ms, seq = _last_id_tick
+    if ms > last_ms:
+        seq = 0
+    else:
+        ms, seq = last_ms, seq + 1
+        if seq > 0xFFF:
+            ms, seq = ms + 1, 0
+    _last_id_tick = (ms, seq)
+    value = (ms << 80) | (0x7 << 76) | (seq << 64) | (0b10 << 62) | secrets.randbits(62)
+    return uuid.UUID(int=value).hex
+
+
+def _pdf_safe_text(text: str) -> str:
+    """Replace characters the core PDF fonts (latin-1) cannot encode."""
+    if text.isascii():
+        return text
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+
+_safe_contents: "OrderedDict[str, str]" = OrderedDict()
+_safe_contents_lock = threading.Lock()  # PDFs are rendered on worker threads
+
+
+def _pdf_safe_content(message_id: str, content: str) -> str:
+    """_pdf_safe_text for a message body, memoized by message id across exports."""
+    with _safe_contents_lock:
+        safe = _safe_contents.get(message_id)
+        if safe is not None:
+            _safe_contents.move_to_end(message_id)
+            return safe
+    safe = _pdf_safe_text(content)
+    with _safe_contents_lock:
+        _safe_contents[message_id] = safe
+        if len(_safe_contents) > SAFE_CONTENT_CACHE_SIZE:
+            _safe_contents.popitem(last=False)
+    return safe
+
 
 class ChatService:
     """Service for managing chat sessions and exporting conversations."""
     
     def __init__(self):
         self.db = database_service
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._pending = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._writer_task: Optional[asyncio.Task] = None
+        # Rows from a batch whose write failed; retried before the queue
+        self._unwritten: list[tuple] = []
     
     async def initialize(self) -> None:
-        """Initialize the underlying database."""
+        """Initialize the underlying database and start the background message writer."""
         await self.db.initialize()
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._drain_loop())
+    
+    async def close(self) -> None:
+        """Stop the background writer, persist any queued messages and close the database."""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.exception("Message writer stopped with an error")
+            self._writer_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Could not persist queued messages on shutdown")
+        finally:
+            await self.db.close()
+    
+    async def _drain_loop(self) -> None:
+        """Write queued messages in batches shortly after they arrive."""
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(WRITE_INTERVAL_SECONDS)
+            self._pending.clear()
+            try:
+                # Shielded so shutdown cannot drop rows already taken off the queue
+                await asyncio.shield(self.flush())
+            except Exception:
+                # flush() kept the failed batch; back off, then try again
+                logger.exception("Writing queued messages failed; retrying")
+                await asyncio.sleep(WRITE_RETRY_SECONDS)
+                self._pending.set()
+    
+    async def flush(self) -> None:
+        """
+        Persist all queued messages now.
+        
+        If a batch cannot be written it is kept for the next flush and the
+        error is raised to the caller.
+        """
+        async with self._write_lock:
+            while self._unwritten or not self._queue.empty():
+                rows, self._unwritten = self._unwritten, []
+                while len(rows) < WRITE_BATCH_SIZE and not self._queue.empty():
+                    rows.append(self._queue.get_nowait())
+                try:
+                    await self.db.add_messages(rows)
+                except Exception:
+                    self._unwritten = rows
+                    raise
     
     # ==================== Session Management ====================
     
     async def create_session(self, doc_id: str, title: Optional[str] = None) -> dict:
         """Create a new chat session for a document."""
-        session_id = str(uuid.uuid4())
+        session_id = _time_ordered_id()
         if not title:
             title = "New Chat"
         
@@ -33,33 +170,30 @@ class ChatService:
     
     async def get_sessions(self, doc_id: Optional[str] = None) -> list[dict]:
         """Get all sessions, optionally filtered by document ID."""
+        await self.flush()
         return await self.db.get_sessions(doc_id)
     
     async def get_session(self, session_id: str) -> Optional[dict]:
         """Get a session by ID."""
+        await self.flush()
         return await self.db.get_session(session_id)
     
     async def get_session_with_messages(self, session_id: str) -> Optional[dict]:
         """Get a session with all its messages."""
+        await self.flush()
         session = await self.db.get_session_with_messages(session_id)
         if session and session.get("messages"):
-            # Parse citations_json for each message
-            for msg in session["messages"]:
-                if msg.get("citations_json"):
-                    try:
-                        msg["citations"] = json.loads(msg["citations_json"])
-                    except json.JSONDecodeError:
-                        msg["citations"] = []
-                else:
-                    msg["citations"] = []
+            self._parse_citations(session["messages"])
         return session
     
     async def delete_session(self, session_id: str) -> bool:
         """Delete a session and all its messages."""
+        await self.flush()
         return await self.db.delete_session(session_id)
     
     async def update_session_title(self, session_id: str, title: str) -> None:
         """Update the title of a session."""
+        await self.flush()
         await self.db.update_session_title(session_id, title)
     
     # ==================== Message Management ====================
@@ -71,98 +205,119 @@ class ChatService:
         content: str,
         citations: Optional[list[dict]] = None
     ) -> dict:
-        """Add a message to a session."""
-        message_id = str(uuid.uuid4())
-        citations_json = json.dumps(citations) if citations else None
-        
-        message = await self.db.add_message(
-            message_id=message_id,
-            session_id=session_id,
-            role=role,
-            content=content,
-            citations_json=citations_json
-        )
+        """
+        Add a message to a session.
+        
+        Once the background writer is running the message is queued and
+        written in a batch; pending messages are flushed before any read.
+        """
+        message_id = _time_ordered_id()
+        citations_json = orjson.dumps(citations).decode() if citations else None
+        
+        if self._writer_task is None:
+            message = await self.db.add_message(
+                message_id=message_id,
+                session_id=session_id,
+                role=role,
+                content=content,
+                citations_json=citations_json
+            )
+        else:
+            now = datetime.utcnow().isoformat()
+            row = (message_id, session_id, role, content, citations_json, now)
+            try:
+                self._queue.put_nowait(row)
+            except asyncio.QueueFull:
+                await self.flush()
+                self._queue.put_nowait(row)
+            self._pending.set()
+            message = {
+                "id": message_id,
+                "session_id": session_id,
+                "role": role,
+                "content": content,
+                "citations_json": citations_json,
+                "created_at": now
+            }
         
         # Return with parsed citations
         message["citations"] = citations or []
         return message
     
-    async def get_messages(self, session_id: str) -> list[dict]:
-        """Get all messages for a session with parsed citations."""
-        messages = await self.db.get_messages(session_id)
-        
+    @staticmethod
+    def _parse_citations(messages: list[dict]) -> None:
+        """Decode each message's citations_json into a citations list, in place."""
+        loads = orjson.loads
         for msg in messages:
-            if msg.get("citations_json"):
-                try:
-                    msg["citations"] = json.loads(msg["citations_json"])
-                except json.JSONDecodeError:
-                    msg["citations"] = []
-            else:
+            try:
+                msg["citations"] = loads(cj) if (cj := msg.get("citations_json")) else []
+            except orjson.JSONDecodeError:
                 msg["citations"] = []
-        
-        return messages
     
     # ==================== Export Functions ====================
     
-    async def export_markdown(self, session_id: str) -> Optional[str]:
-        """Export a session as markdown."""
-        session = await self.get_session_with_messages(session_id)
-        if not session:
-            return None
+    def _markdown_parts(self, session: dict) -> Iterator[str]:
+        """Render a session as markdown, one header or message block at a time."""
+        buf = StringIO()
+        write = buf.write
+        
+        def take() -> str:
+            part = buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+            return part
         
-        lines = []
-        lines.append(f"# {session['title']}")
-        lines.append("")
-        lines.append(f"*Document ID: {session['doc_id']}*")
-        lines.append(f"*Created: {session['created_at']}*")
-        lines.append("")
-        lines.append("---")
-        lines.append("")
+        write(f"# {session['title']}\n\n")
+        write(f"*Document ID: {session['doc_id']}*\n")
+        write(f"*Created: {session['created_at']}*\n\n")
+        write("---\n\n")
+        yield take()
         
         for msg in session.get("messages", []):
             role_label = "**User:**" if msg["role"] == "user" else "**Assistant:**"
-            lines.append(role_label)
-            lines.append("")
-            lines.append(msg["content"])
-            lines.append("")
+            write(f"{role_label}\n\n{msg['content']}\n\n")
             
             # Add citations if present
             citations = msg.get("citations", [])
             if citations:
-                lines.append("*Citations:*")
+                write("*Citations:*\n")
                 for i, citation in enumerate(citations, 1):
-                    page = citation.get("page", "N/A")
-                    confidence = citation.get("confidence", 0)
-                    text = citation.get("text", "")[:200]  # Truncate long citations
-                    lines.append(f"  {i}. Page {page} (confidence: {confidence:.0%}): \"{text}...\"")
-                lines.append("")
+                    get = citation.get
+                    percent = round(get("confidence", 0) * 100)
+                    text = get("text", "")[:200]  # Truncate long citations
+                    write(f"  {i}. Page {get('page', 'N/A')} (confidence: {percent}%): \"{text}...\"\n")
+                write("\n")
             
-            lines.append("---")
-            lines.append("")
-        
-        return "\n".join(lines)
+            write("---\n\n")
+            yield take()
     
-    async def export_pdf(self, session_id: str) -> Optional[bytes]:
-        """Export a session as PDF."""
+    async def export_markdown(self, session_id: str) -> Optional[str]:
+        """Export a session as markdown."""
         session = await self.get_session_with_messages(session_id)
         if not session:
             return None
-        
+        return "".join(self._markdown_parts(session))
+    
+    async def stream_markdown(self, session_id: str) -> AsyncIterator[str]:
+        """Export a session as markdown, yielding one message block at a time."""
+        session = await self.get_session_with_messages(session_id)
+        if not session:
+            return
+        for part in self._markdown_parts(session):
+            yield part
+    
+    def _start_pdf(self, session: dict) -> FPDF:
+        """Create a PDF and lay out the session header (CPU-bound; run off the event loop)."""
         pdf = FPDF()
         pdf.set_margins(15, 15, 15)
         pdf.set_auto_page_break(auto=True, margin=20)
         pdf.add_page()
         
-        # Calculate effective width
         effective_width = pdf.w - pdf.l_margin - pdf.r_margin
         
-        # Helper to safely encode text for PDF
-        def safe_text(text: str) -> str:
-            return text.encode('latin-1', 'replace').decode('latin-1')
-        
         # Title
         pdf.set_font("Helvetica", "B", 14)
-        title = safe_text(session["title"][:100])  # Truncate very long titles
+        title = _pdf_safe_text(session["title"][:100])  # Truncate very long titles
         pdf.multi_cell(effective_width, 8, title)
         pdf.ln(2)
         
@@ -176,8 +331,13 @@ class ChatService:
         pdf.set_draw_color(200, 200, 200)
         pdf.line(pdf.l_margin, pdf.get_y(), pdf.w - pdf.r_margin, pdf.get_y())
         pdf.ln(5)
+        return pdf
+    
+    def _render_pdf_messages(self, pdf: FPDF, messages: list[dict]) -> None:
+        """Append messages to a PDF started by _start_pdf (CPU-bound; run off the event loop)."""
+        effective_width = pdf.w - pdf.l_margin - pdf.r_margin
         
-        for msg in session.get("messages", []):
+        for msg in messages:
             # Role header
             role_label = "User:" if msg["role"] == "user" else "Assistant:"
             pdf.set_font("Helvetica", "B", 10)
@@ -185,7 +345,7 @@ class ChatService:
             
             # Message content
             pdf.set_font("Helvetica", "", 9)
-            content = safe_text(msg["content"])
+            content = _pdf_safe_content(msg["id"], msg["content"])
             pdf.multi_cell(effective_width, 5, content)
             pdf.ln(2)
             
@@ -195,20 +355,61 @@ class ChatService:
                 pdf.set_font("Helvetica", "I", 8)
                 pdf.cell(effective_width, 5, "Citations:", new_x="LMARGIN", new_y="NEXT")
                 for i, citation in enumerate(citations, 1):
-                    page = citation.get("page", "N/A")
-                    confidence = citation.get("confidence", 0)
-                    text = safe_text(citation.get("text", "")[:80])  # Shorter truncation
-                    citation_text = f"{i}. Page {page} ({confidence:.0%}): {text}..."
-                    pdf.multi_cell(effective_width, 4, citation_text)
+                    get = citation.get
+                    percent = round(get("confidence", 0) * 100)
+                    text = _pdf_safe_text(get("text", "")[:80])  # Shorter truncation
+                    pdf.multi_cell(effective_width, 4, f"{i}. Page {get('page', 'N/A')} ({percent}%): {text}...")
                 pdf.ln(2)
             
             # Separator
             pdf.set_draw_color(220, 220, 220)
             pdf.line(pdf.l_margin, pdf.get_y(), pdf.w - pdf.r_margin, pdf.get_y())
             pdf.ln(5)
+    
+    @staticmethod
+    def _finish_pdf(pdf: FPDF, output_stream: Optional[BinaryIO] = None) -> Optional[bytearray]:
+        """
+        Serialize a PDF, deflating page streams (fpdf2's default compression).
         
-        # Return as bytes
-        return bytes(pdf.output())
+        Writes to output_stream and returns None when one is given, otherwise
+        returns fpdf2's output buffer without copying it.
+        """
+        if output_stream is not None:
+            pdf.output(output_stream)
+            return None
+        return pdf.output()
+    
+    async def export_pdf(
+        self,
+        session_id: str,
+        output_stream: Optional[BinaryIO] = None
+    ) -> Optional[bytearray]:
+        """
+        Export a session as PDF.
+        
+        Messages are loaded and laid out EXPORT_MESSAGE_BATCH at a time, so
+        long chats never hold every message dict in memory at once.
+        If output_stream is given the document is written there and None is
+        returned; otherwise the PDF content is returned.
+        """
+        session = await self.get_session(session_id)
+        if not session:
+            return None
+        
+        pdf = await asyncio.to_thread(self._start_pdf, session)
+        async for messages in self.db.iter_messages(session_id, EXPORT_MESSAGE_BATCH):
+            self._parse_citations(messages)
+            await asyncio.to_thread(self._render_pdf_messages, pdf, messages)
+        return await asyncio.to_thread(self._finish_pdf, pdf, output_stream)
+    
+    async def stream_pdf(self, session_id: str) -> AsyncIterator[bytes]:
+        """Export a session as PDF, yielding the document in fixed-size chunks."""
+        # Spool to a temp file so the rendered PDF is not held in memory while streaming
+        with tempfile.TemporaryFile() as spool:
+            await self.export_pdf(session_id, output_stream=spool)
+            spool.seek(0)
+            while chunk := spool.read(EXPORT_CHUNK_SIZE):
+                yield chunk
 
 
 # Singleton instance
@@ -2,12 +2,23 @@
 Database service for SQLite-based chat history persistence.
 """
 
+import asyncio
 import aiosqlite
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from typing import AsyncIterator, Optional
 from config import settings
 
+# Hot-path statements are shared constants: sqlite3 keeps a per-connection
+# cache of prepared statements keyed by SQL text, so with the long-lived
+# connection each one is parsed once and reused on every call.
+_INSERT_MESSAGE_SQL = """
+    INSERT INTO chat_messages (id, session_id, role, content, citations_json, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_TOUCH_SESSION_SQL = "UPDATE chat_sessions SET updated_at = ? WHERE id = ?"
+
 
 class DatabaseService:
     """Async SQLite database service for chat sessions and messages."""
@@ -15,63 +26,96 @@ class DatabaseService:
     def __init__(self, db_path: str = "./chat_history.db"):
         self.db_path = db_path
         self._initialized = False
+        self._db: Optional[aiosqlite.Connection] = None
+        # Statements from different coroutines share one connection and so one
+        # transaction; holding this keeps them from interleaving
+        self._lock = asyncio.Lock()
     
     async def initialize(self) -> None:
-        """Create tables if they don't exist."""
+        """Open the shared connection and create tables if they don't exist."""
         if self._initialized:
             return
-            
-        async with aiosqlite.connect(self.db_path) as db:
-            # Create chat_sessions table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS chat_sessions (
-                    id TEXT PRIMARY KEY,
-                    doc_id TEXT NOT NULL,
-                    title TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL
-                )
-            """)
-            
-            # Create chat_messages table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    id TEXT PRIMARY KEY,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    citations_json TEXT,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
-                )
-            """)
-            
-            # Create indexes for faster queries
-            await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_sessions_doc_id ON chat_sessions(doc_id)
-            """)
-            await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_messages_session_id ON chat_messages(session_id)
-            """)
-            
-            await db.commit()
+        
+        # One connection for the process lifetime; connecting per query costs
+        # more than the small reads and writes chat operations actually run
+        self._db = db = await aiosqlite.connect(self.db_path)
+        db.row_factory = aiosqlite.Row
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA mmap_size=268435456")
+        
+        # Create chat_sessions table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                id TEXT PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        
+        # Create chat_messages table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                citations_json TEXT,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # Create indexes for faster queries
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sessions_doc_id ON chat_sessions(doc_id)
+        """)
+        # (session_id, created_at) serves both the filter and the ORDER BY;
+        # it supersedes the older session_id-only index
+        await db.execute("DROP INDEX IF EXISTS idx_messages_session_id")
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_session_created ON chat_messages(session_id, created_at)
+        """)
+        
+        await db.commit()
         
         self._initialized = True
     
+    async def close(self) -> None:
+        """Close the shared connection."""
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+        self._initialized = False
+    
     async def _ensure_initialized(self) -> None:
         """Ensure database is initialized before operations."""
         if not self._initialized:
             await self.initialize()
     
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Run one write transaction: commit if the block succeeds, roll back if it raises."""
+        await self._ensure_initialized()
+        async with self._lock:
+            db = self._db
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            await db.commit()
+    
     # ==================== Session Operations ====================
     
     async def create_session(self, session_id: str, doc_id: str, title: str) -> dict:
         """Create a new chat session."""
-        await self._ensure_initialized()
-        
         now = datetime.utcnow().isoformat()
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """
                 INSERT INTO chat_sessions (id, doc_id, title, created_at, updated_at)
@@ -79,7 +123,6 @@ class DatabaseService:
                 """,
                 (session_id, doc_id, title, now, now)
             )
-            await db.commit()
         
         return {
             "id": session_id,
@@ -93,66 +136,41 @@ class DatabaseService:
         """Get a session by ID."""
         await self._ensure_initialized()
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM chat_sessions WHERE id = ?",
-                (session_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-        return None
+        async with self._lock, self._db.execute(
+            "SELECT * FROM chat_sessions WHERE id = ?",
+            (session_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return dict(row) if row else None
     
     async def get_sessions(self, doc_id: Optional[str] = None) -> list[dict]:
         """Get all sessions, optionally filtered by doc_id."""
         await self._ensure_initialized()
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            
-            if doc_id:
-                query = "SELECT * FROM chat_sessions WHERE doc_id = ? ORDER BY updated_at DESC"
-                params = (doc_id,)
-            else:
-                query = "SELECT * FROM chat_sessions ORDER BY updated_at DESC"
-                params = ()
-            
-            async with db.execute(query, params) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
-    
-    async def update_session_timestamp(self, session_id: str) -> None:
-        """Update the updated_at timestamp for a session."""
-        await self._ensure_initialized()
-        
-        now = datetime.utcnow().isoformat()
+        if doc_id:
+            query = "SELECT * FROM chat_sessions WHERE doc_id = ? ORDER BY updated_at DESC"
+            params = (doc_id,)
+        else:
+            query = "SELECT * FROM chat_sessions ORDER BY updated_at DESC"
+            params = ()
         
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE chat_sessions SET updated_at = ? WHERE id = ?",
-                (now, session_id)
-            )
-            await db.commit()
+        async with self._lock, self._db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
     
     async def update_session_title(self, session_id: str, title: str) -> None:
         """Update the title of a session."""
-        await self._ensure_initialized()
-        
         now = datetime.utcnow().isoformat()
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE chat_sessions SET title = ?, updated_at = ? WHERE id = ?",
                 (title, now, session_id)
             )
-            await db.commit()
     
     async def delete_session(self, session_id: str) -> bool:
         """Delete a session and all its messages."""
-        await self._ensure_initialized()
-        
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             # Delete messages first (foreign key)
             await db.execute(
                 "DELETE FROM chat_messages WHERE session_id = ?",
@@ -163,8 +181,7 @@ class DatabaseService:
                 "DELETE FROM chat_sessions WHERE id = ?",
                 (session_id,)
             )
-            await db.commit()
-            return cursor.rowcount > 0
+        return cursor.rowcount > 0
     
     # ==================== Message Operations ====================
     
@@ -177,22 +194,18 @@ class DatabaseService:
         citations_json: Optional[str] = None
     ) -> dict:
         """Add a message to a session."""
-        await self._ensure_initialized()
-        
         now = datetime.utcnow().isoformat()
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
-                """
-                INSERT INTO chat_messages (id, session_id, role, content, citations_json, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
+                _INSERT_MESSAGE_SQL,
                 (message_id, session_id, role, content, citations_json, now)
             )
-            await db.commit()
-        
-        # Update session timestamp
-        await self.update_session_timestamp(session_id)
+            # Bump the session in the same transaction, stamped with the message time
+            await db.execute(
+                _TOUCH_SESSION_SQL,
+                (now, session_id)
+            )
         
         return {
             "id": message_id,
@@ -203,28 +216,100 @@ class DatabaseService:
             "created_at": now
         }
     
-    async def get_messages(self, session_id: str) -> list[dict]:
-        """Get all messages for a session."""
+    async def add_messages(self, messages: list[tuple]) -> None:
+        """
+        Insert a batch of messages in one transaction.
+        
+        Each tuple is (id, session_id, role, content, citations_json, created_at).
+        Every affected session's updated_at is set to its newest message.
+        """
+        if not messages:
+            return
+        
+        latest: dict[str, str] = {}
+        for message in messages:
+            latest[message[1]] = message[5]
+        
+        async with self._write() as db:
+            await db.executemany(
+                _INSERT_MESSAGE_SQL,
+                messages
+            )
+            await db.executemany(
+                _TOUCH_SESSION_SQL,
+                [(updated_at, session_id) for session_id, updated_at in latest.items()]
+            )
+    
+    async def iter_messages(self, session_id: str, batch_size: int = 500) -> AsyncIterator[list[dict]]:
+        """
+        Yield a session's messages in order, batch_size rows at a time.
+        
+        Pages by (created_at, id) rather than OFFSET so each batch is a
+        seek into idx_messages_session_created instead of a rescan.
+        """
         await self._ensure_initialized()
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM chat_messages WHERE session_id = ? ORDER BY created_at ASC",
-                (session_id,)
+        query = """
+            SELECT * FROM chat_messages
+            WHERE session_id = ? AND (created_at > ? OR (created_at = ? AND id > ?))
+            ORDER BY created_at ASC, id ASC
+            LIMIT ?
+        """
+        last_created, last_id = "", ""
+        while True:
+            # Lock per page only: the caller runs between pages
+            async with self._lock, self._db.execute(
+                query, (session_id, last_created, last_created, last_id, batch_size)
             ) as cursor:
                 rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_created, last_id = rows[-1]["created_at"], rows[-1]["id"]
     
     async def get_session_with_messages(self, session_id: str) -> Optional[dict]:
-        """Get a session with all its messages."""
-        session = await self.get_session(session_id)
-        if not session:
+        """Get a session with all its messages in a single query."""
+        await self._ensure_initialized()
+        
+        async with self._lock, self._db.execute(
+            """
+            SELECT s.id AS sid, s.doc_id, s.title, s.created_at, s.updated_at,
+                   m.id AS mid, m.role, m.content, m.citations_json, m.created_at AS m_created
+            FROM chat_sessions s
+            LEFT JOIN chat_messages m ON m.session_id = s.id
+            WHERE s.id = ?
+            ORDER BY m.created_at ASC
+            """,
+            (session_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        
+        if not rows:
             return None
         
-        messages = await self.get_messages(session_id)
-        session["messages"] = messages
-        return session
+        first = rows[0]
+        return {
+            "id": first["sid"],
+            "doc_id": first["doc_id"],
+            "title": first["title"],
+            "created_at": first["created_at"],
+            "updated_at": first["updated_at"],
+            # A session without messages yields one row with NULL message columns
+            "messages": [
+                {
+                    "id": row["mid"],
+                    "session_id": session_id,
+                    "role": row["role"],
+                    "content": row["content"],
+                    "citations_json": row["citations_json"],
+                    "created_at": row["m_created"]
+                }
+                for row in rows
+                if row["mid"] is not None
+            ]
+        }
 
 
 # Singleton instance
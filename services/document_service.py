@@ -1,12 +1,133 @@
+import asyncio
+import os
+import threading
 import uuid
-import re
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import List, Dict, Any
-import pdfplumber
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import List, Dict, Any, Tuple
+import aiofiles
+import numpy as np
+import pypdfium2 as pdfium
+from fastapi import UploadFile
 
 from config import settings
 
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# PDF readers accept the header anywhere in the first 1024 bytes
+PDF_HEADER_WINDOW = 1024
+
+# Smallest page range handed to one extraction worker; each task reopens the PDF
+MIN_PAGES_PER_TASK = 8
+
+
+class UnsupportedContentError(ValueError):
+    """Raised when an upload's content does not match its claimed file type."""
+
+
+# Preferred chunk boundaries, best first; a chunk that finds none is cut mid-word
+SPLIT_SEPARATORS = (
+    "\n\n",      # Double newlines (paragraphs)
+    "\n",        # Single newlines
+    ". ",        # Sentence boundaries
+    "? ",        # Question boundaries
+    "! ",        # Exclamation boundaries
+    "; ",        # Semicolon boundaries
+    ", ",        # Comma boundaries
+    " ",         # Word boundaries
+)
+
+
+def split_text_fast(text: str, chunk_size: int, chunk_overlap: int) -> Tuple[List[str], List[int]]:
+    """Split text into overlapping chunks in a single left-to-right pass.
+
+    Each window of chunk_size characters is cut at the best separator found
+    in its second half (searched with str.rfind), and the next window starts
+    chunk_overlap characters before that cut, snapped forward to a word start.
+
+    Returns:
+        Tuple of (whitespace-stripped chunks, offset of each chunk in text)
+    """
+    chunks: List[str] = []
+    starts: List[int] = []
+    length = len(text)
+    start = 0
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            floor = start + chunk_size // 2
+            for sep in SPLIT_SEPARATORS:
+                cut = text.rfind(sep, floor, end)
+                if cut != -1:
+                    end = cut + len(sep)
+                    break
+
+        chunk = text[start:end]
+        stripped = chunk.strip()
+        if stripped:
+            chunks.append(stripped)
+            starts.append(start + len(chunk) - len(chunk.lstrip()))
+        if end >= length:
+            break
+
+        next_start = end - chunk_overlap
+        space = text.find(" ", next_start, end)
+        if space != -1:
+            next_start = space + 1
+        start = max(next_start, start + 1)
+    return chunks, starts
+
+
+def _preallocate(path: Path, size: int) -> None:
+    """Create an empty file and reserve size bytes so it is laid out contiguously."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass  # Filesystem cannot reserve space; the writes below still work
+    finally:
+        os.close(fd)
+
+
+def _read_pdf_pages(file_path: str, start: int = 0, stop: int | None = None) -> List[Tuple[int, str]]:
+    """Extract whitespace-normalized text for pages [start, stop) as (page_number, text) pairs.
+
+    Pages without extractable text are skipped.
+    """
+    pages = []
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        stop = len(pdf) if stop is None else min(stop, len(pdf))
+        for index in range(start, stop):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                text = textpage.get_text_range()
+            finally:
+                # Free PDFium's native buffers as we go rather than at document close
+                textpage.close()
+                page.close()
+            if text:
+                # Clean up text: collapse whitespace runs (split/join strips too)
+                pages.append((index + 1, " ".join(text.split())))
+    finally:
+        pdf.close()
+    return pages
+
+
+def _pages_for_offsets(
+    offsets: np.ndarray,
+    page_starts: np.ndarray,
+    page_numbers: np.ndarray
+) -> np.ndarray:
+    """Vectorized lookup of the page containing each character offset.
+
+    page_starts must be sorted; offsets before the first page map to it.
+    """
+    index = np.searchsorted(page_starts, offsets, side="right") - 1
+    return page_numbers[np.clip(index, 0, None)]
+
 
 class DocumentService:
     SUPPORTED_EXTENSIONS = {'.pdf', '.txt', '.md'}
@@ -14,32 +135,46 @@ class DocumentService:
     def __init__(self):
         self.upload_dir = Path(settings.UPLOAD_DIR)
         self.upload_dir.mkdir(exist_ok=True)
-        # Use sentence-aware separators for better semantic chunking
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=settings.CHUNK_SIZE,
-            chunk_overlap=settings.CHUNK_OVERLAP,
-            separators=[
-                "\n\n",      # Double newlines (paragraphs)
-                "\n",        # Single newlines
-                ". ",        # Sentence boundaries
-                "? ",        # Question boundaries
-                "! ",        # Exclamation boundaries  
-                "; ",        # Semicolon boundaries
-                ", ",        # Comma boundaries
-                " ",         # Word boundaries
-                ""           # Character boundaries (last resort)
-            ],
-            length_function=len,
-            is_separator_regex=False,
-        )
-
-    def save_document(self, file_content: bytes, filename: str) -> tuple[str, str]:
-        """Save document locally and return doc_id and file path."""
-        doc_id = str(uuid.uuid4())
+        # doc_id -> original filename, refreshed when the upload dir's mtime changes
+        self._filenames: Dict[str, str] = {}
+        self._filenames_mtime: int | None = None
+        # Lookups run on the event loop and in to_thread workers
+        self._filenames_lock = threading.Lock()
+        self.chunk_size = settings.CHUNK_SIZE
+        self.chunk_overlap = settings.CHUNK_OVERLAP
+
+    @staticmethod
+    def _content_matches_extension(head: bytes, ext: str) -> bool:
+        """Check the leading bytes of a file against its claimed extension."""
+        if ext == "pdf":
+            return b"%PDF-" in head[:PDF_HEADER_WINDOW]
+        # txt/md: reject obviously binary content
+        return b"\x00" not in head
+
+    async def save_document(self, file: UploadFile, filename: str) -> tuple[str, str]:
+        """
+        Stream an upload to disk in fixed-size chunks and return doc_id and file path.
+
+        Raises:
+            UnsupportedContentError: If the file's leading bytes do not match its extension
+        """
+        ext = filename.rpartition(".")[2].lower()
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not self._content_matches_extension(chunk, ext):
+            raise UnsupportedContentError(f"File content does not match the .{ext} extension")
+
+        doc_id = uuid.uuid4().hex
         file_path = self.upload_dir / f"{doc_id}_{filename}"
 
-        with open(file_path, "wb") as f:
-            f.write(file_content)
+        size = file.size or 0
+        if size:
+            await asyncio.to_thread(_preallocate, file_path, size)
+        async with aiofiles.open(file_path, "r+b" if size else "wb") as f:
+            while chunk:
+                await f.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            # Drop any reserved space the upload did not fill
+            await f.truncate()
 
         return doc_id, str(file_path)
 
@@ -60,52 +195,70 @@ class DocumentService:
         Strategy: Combine all pages with page markers, then chunk semantically.
         This avoids breaking content that spans pages and preserves context.
         """
-        chunks_with_metadata = []
+        return self._chunk_pdf_pages(file_path, _read_pdf_pages(file_path))
+
+    def _chunk_pdf_pages(self, file_path: str, pages: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+        """Chunk extracted (page_number, text) pairs, tagging each chunk with its starting page."""
+        if not pages:
+            return []
+
         filename = Path(file_path).stem.split('_', 1)[-1]  # Get original filename without doc_id
         
-        # First pass: extract all text with page markers
-        page_texts = []
-        page_boundaries = {}  # Maps character position to page number
+        page_starts = []  # Character offset where each page's text begins
+        page_numbers = []
         current_pos = 0
-        
-        with pdfplumber.open(file_path) as pdf:
-            for page_num, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text()
-                if text:
-                    # Clean up text: normalize whitespace
-                    text = re.sub(r'\s+', ' ', text).strip()
-                    page_boundaries[current_pos] = page_num
-                    page_texts.append(text)
-                    current_pos += len(text) + 2  # +2 for "\n\n" separator
-        
-        if not page_texts:
-            return []
+        for page_num, text in pages:
+            page_starts.append(current_pos)
+            page_numbers.append(page_num)
+            current_pos += len(text) + 2  # +2 for "\n\n" separator
         
         # Combine all text with paragraph separators
-        full_text = "\n\n".join(page_texts)
+        full_text = "\n\n".join(text for _, text in pages)
         
         # Chunk the combined text
-        raw_chunks = self.text_splitter.split_text(full_text)
+        raw_chunks, chunk_starts = split_text_fast(full_text, self.chunk_size, self.chunk_overlap)
         
-        # Assign page numbers to chunks based on position
-        for chunk_text in raw_chunks:
-            # Find which page this chunk starts in
-            chunk_start = full_text.find(chunk_text)
-            page_num = 1
-            for pos, pnum in sorted(page_boundaries.items()):
-                if chunk_start >= pos:
-                    page_num = pnum
-                else:
-                    break
-            
-            # Add contextual prefix for better retrieval
-            context_prefix = f"[Document: {filename}] "
-            chunks_with_metadata.append({
-                "text": context_prefix + chunk_text,
-                "page": page_num
-            })
+        # Assign page numbers to chunks based on where each chunk starts
+        chunk_pages = _pages_for_offsets(
+            np.asarray(chunk_starts, dtype=np.int64),
+            np.asarray(page_starts, dtype=np.int64),
+            np.asarray(page_numbers, dtype=np.int64)
+        ).tolist()
+        
+        # Add contextual prefix for better retrieval
+        context_prefix = f"[Document: {filename}] "
+        return [
+            {"text": f"{context_prefix}{chunk_text}", "page": page_num}
+            for chunk_text, page_num in zip(raw_chunks, chunk_pages)
+        ]
+
+    async def aextract_and_chunk(self, file_path: str, executor: Executor) -> List[Dict[str, Any]]:
+        """
+        Extract and chunk a document on a process pool.
+
+        PDF pages are split into contiguous ranges extracted by separate
+        workers; the page texts are then chunked together so chunks can
+        still span page boundaries.
+
+        Args:
+            file_path: Path of the saved upload
+            executor: Process pool to run extraction on
+
+        Returns:
+            Chunks in document order, as returned by extract_and_chunk_text
+        """
+        loop = asyncio.get_running_loop()
+        if Path(file_path).suffix.lower() != '.pdf':
+            return await loop.run_in_executor(executor, extract_and_chunk_file, file_path)
 
-        return chunks_with_metadata
+        page_count = await loop.run_in_executor(executor, count_pdf_pages, file_path)
+        span = max(MIN_PAGES_PER_TASK, -(-page_count // (os.cpu_count() or 1)))
+        page_ranges = await asyncio.gather(*(
+            loop.run_in_executor(executor, _read_pdf_pages, file_path, start, start + span)
+            for start in range(0, page_count, span)
+        ))
+        pages = [page for page_range in page_ranges for page in page_range]
+        return await loop.run_in_executor(executor, chunk_pdf_pages, file_path, pages)
 
     def _extract_text(self, file_path: str) -> List[Dict[str, Any]]:
         """Extract text from txt/md files with contextual prefixing."""
@@ -114,27 +267,72 @@ class DocumentService:
         with open(file_path, 'r', encoding='utf-8') as f:
             text = f.read()
 
-        chunks = self.text_splitter.split_text(text)
+        chunks, _ = split_text_fast(text, self.chunk_size, self.chunk_overlap)
         
         # Add contextual prefix for better retrieval
         context_prefix = f"[Document: {filename}] "
-        return [{"text": context_prefix + chunk, "page": 1} for chunk in chunks]
+        return [{"text": f"{context_prefix}{chunk}", "page": 1} for chunk in chunks]
+
+    def _upload_dir_mtime(self) -> int:
+        return os.stat(self.upload_dir).st_mtime_ns
+
+    def _filename_index(self) -> Dict[str, str]:
+        """doc_id -> original filename, rescanning the upload dir only when its mtime changes.
+
+        The returned dict is never mutated; a rescan replaces it. The mtime is
+        read before scanning, so a file added mid-scan triggers another rescan.
+        """
+        with self._filenames_lock:
+            mtime = self._upload_dir_mtime()
+            if mtime != self._filenames_mtime:
+                filenames = {}
+                with os.scandir(self.upload_dir) as entries:
+                    for entry in entries:
+                        doc_id, sep, filename = entry.name.partition("_")
+                        if sep:
+                            filenames[doc_id] = filename
+                self._filenames = filenames
+                self._filenames_mtime = mtime
+            return self._filenames
 
     def get_filename_by_doc_id(self, doc_id: str) -> str | None:
-        """Get original filename from doc_id by searching uploads folder."""
-        for file_path in self.upload_dir.iterdir():
-            if file_path.name.startswith(f"{doc_id}_"):
-                # Extract original filename (remove doc_id prefix)
-                return file_path.name[len(doc_id) + 1:]
-        return None
+        """Get original filename from doc_id."""
+        return self._filename_index().get(doc_id)
+
+    def get_filenames_bulk(self, doc_ids: List[str]) -> Dict[str, str]:
+        """Map doc_ids to original filenames using at most one directory scan."""
+        filenames = self._filename_index()
+        return {doc_id: filenames[doc_id] for doc_id in doc_ids if doc_id in filenames}
 
     def delete_document_file(self, doc_id: str) -> bool:
         """Delete document file from uploads folder."""
-        for file_path in self.upload_dir.iterdir():
-            if file_path.name.startswith(f"{doc_id}_"):
-                file_path.unlink()
-                return True
-        return False
-
+        filename = self._filename_index().get(doc_id)
+        if filename is None:
+            return False
+        (self.upload_dir / f"{doc_id}_{filename}").unlink(missing_ok=True)
+        return True
 
 document_service = DocumentService()
+
+
+def extract_and_chunk_file(file_path: str) -> List[Dict[str, Any]]:
+    """Module-level entry point for process pool workers.
+
+    Submitting the bound method would pickle the whole service on every
+    call; workers use their own singleton instead.
+    """
+    return document_service.extract_and_chunk_text(file_path)
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """Process pool entry point: number of pages in a PDF."""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def chunk_pdf_pages(file_path: str, pages: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """Process pool entry point: chunk page texts gathered from several workers."""
+    return document_service._chunk_pdf_pages(file_path, pages)
@@ -1,45 +1,264 @@
-from typing import List
-from openai import OpenAI
+import asyncio
+import base64
+import bisect
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import numpy as np
 
 from config import settings
+from services.openai_client import async_openai_client
+
+# SQLite caps the number of bound parameters per statement
+_CACHE_LOOKUP_BATCH = 500
+
+# Entries kept in the in-process cache of single-text embeddings
+_RECENT_CACHE_SIZE = 4096
+
+# Per-request limits of the embeddings endpoint (tokens kept under the 300k cap)
+_MAX_REQUEST_ITEMS = 2048
+_MAX_REQUEST_TOKENS = 250_000
+
+
+def _request_batches(texts: List[str], max_items: int = _MAX_REQUEST_ITEMS) -> List[Tuple[int, int]]:
+    """
+    Split texts into contiguous [start, stop) ranges that each fit in one request.
+
+    A byte-level BPE never emits more tokens than there are UTF-8 bytes, so
+    byte length is a safe token bound without loading a tokenizer.
+
+    Args:
+        texts: Texts to embed
+        max_items: Maximum number of texts per request
+
+    Returns:
+        List of (start, stop) index ranges covering texts in order
+    """
+    ranges = []
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        cost = len(text.encode("utf-8"))
+        if i > start and (i - start >= max_items or tokens + cost > _MAX_REQUEST_TOKENS):
+            ranges.append((start, i))
+            start, tokens = i, 0
+        tokens += cost
+    if start < len(texts):
+        ranges.append((start, len(texts)))
+    return ranges
 
 
 class EmbeddingService:
     def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.async_client = async_openai_client
         self.model = settings.EMBEDDING_MODEL
-    
-    def generate_embedding(self, text: str) -> List[float]:
+        # Caps concurrent embedding requests issued from the async path
+        self._request_slots = asyncio.Semaphore(settings.EMBED_CONCURRENCY)
+
+        # Persistent content-addressed cache (L2) shared by every caller.
+        # Vectors are stored as raw float32 so a hit matches a fresh request exactly.
+        cache_path = Path(settings.EMBED_CACHE_PATH)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self._cache_db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._cache_db.execute("PRAGMA journal_mode=WAL")
+        self._cache_db.execute("PRAGMA synchronous=NORMAL")
+        self._cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL)"
+        )
+        self._cache_lock = threading.Lock()
+
+        # In-process LRU (L1) for repeated single texts such as user questions,
+        # keyed on normalized text; self.model is fixed per instance
+        self._recent: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def _cache_key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).digest()
+
+    def find_uncached_texts(self, texts: List[str]) -> Tuple[List[int], Dict[int, np.ndarray]]:
+        """
+        Look up texts in the persistent embedding cache.
+
+        Args:
+            texts: List of texts to look up
+
+        Returns:
+            Tuple of (indices of texts missing from the cache, {index: cached embedding})
+        """
+        keys = [self._cache_key(text) for text in texts]
+        found: Dict[bytes, bytes] = {}
+        with self._cache_lock:
+            for i in range(0, len(keys), _CACHE_LOOKUP_BATCH):
+                batch = keys[i:i + _CACHE_LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self._cache_db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall())
+
+        uncached_indices = []
+        cached_vectors = {}
+        for i, key in enumerate(keys):
+            vec = found.get(key)
+            if vec is None:
+                uncached_indices.append(i)
+            else:
+                cached_vectors[i] = np.frombuffer(vec, dtype=np.float32)
+        return uncached_indices, cached_vectors
+
+    def _store_embeddings(self, texts: List[str], embeddings: np.ndarray) -> None:
+        """Persist freshly generated embeddings, pruning the oldest past EMBED_CACHE_MAX_ENTRIES."""
+        rows = [
+            (self._cache_key(text), embedding.astype(np.float32, copy=False).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._cache_lock:
+            self._cache_db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", rows
+            )
+            # Rowids grow with each insert, so everything below the newest
+            # max_entries rowids is the oldest part of the cache
+            self._cache_db.execute(
+                "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                (settings.EMBED_CACHE_MAX_ENTRIES,)
+            )
+            self._cache_db.commit()
+
+    @staticmethod
+    def _recent_key(text: str) -> str:
+        """Normalize case and whitespace so trivially different phrasings share an entry."""
+        return " ".join(text.split()).casefold()
+
+    def _recent_get(self, text: str) -> Optional[np.ndarray]:
+        key = self._recent_key(text)
+        embedding = self._recent.get(key)
+        if embedding is not None:
+            self._recent.move_to_end(key)
+        return embedding
+
+    def _recent_put(self, text: str, embedding: np.ndarray) -> None:
+        self._recent[self._recent_key(text)] = embedding
+        if len(self._recent) > _RECENT_CACHE_SIZE:
+            self._recent.popitem(last=False)
+
+    async def agenerate_embedding(self, text: str) -> np.ndarray:
         """
-        Generate embedding for a single text.
-        
+        Generate an embedding for a single text without blocking the event loop.
+
         Args:
             text: The text to embed
-            
+
         Returns:
-            List of floats representing the embedding
+            float32 vector representing the embedding
         """
-        response = self.client.embeddings.create(
-            input=text,
-            model=self.model
-        )
-        return response.data[0].embedding
-    
-    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        embedding = self._recent_get(text)
+        if embedding is None:
+            embedding = (await self.agenerate_embeddings([text]))[0]
+            self._recent_put(text, embedding)
+        return embedding
+
+    @staticmethod
+    def _decode(response) -> np.ndarray:
+        """Decode base64 embeddings straight into a float32 matrix, skipping Python floats."""
+        return np.stack([
+            np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32)
+            for item in response.data
+        ])
+
+    @staticmethod
+    def _assemble(count: int, embeddings: Dict[int, np.ndarray]) -> np.ndarray:
+        if not count:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([embeddings[i] for i in range(count)])
+
+    async def _aembed_request(self, texts: List[str]) -> np.ndarray:
+        """Embed texts that fit in a single request, holding one of the concurrency slots."""
+        async with self._request_slots:
+            response = await self.async_client.embeddings.create(
+                input=texts,
+                model=self.model,
+                encoding_format="base64"
+            )
+        return self._decode(response)
+
+    async def agenerate_embeddings(
+        self,
+        texts: List[str],
+        batch_size: int = _MAX_REQUEST_ITEMS
+    ) -> np.ndarray:
         """
-        Generate embeddings for multiple texts in a single API call.
-        
+        Generate embeddings for multiple texts, calling the API only for uncached texts.
+
+        Uncached texts are split into requests of at most batch_size texts,
+        all submitted at once and bounded by EMBED_CONCURRENCY in flight.
+
         Args:
             texts: List of texts to embed
-            
+            batch_size: Maximum number of texts per embedding request
+
         Returns:
-            List of embeddings
+            float32 array of shape (len(texts), dimensions) in input order
         """
-        response = self.client.embeddings.create(
-            input=texts,
-            model=self.model
-        )
-        return [item.embedding for item in response.data]
+        uncached, embeddings = await asyncio.to_thread(self.find_uncached_texts, texts)
+        if uncached:
+            missing = [texts[i] for i in uncached]
+            fresh = np.concatenate(await asyncio.gather(*(
+                self._aembed_request(missing[start:stop])
+                for start, stop in _request_batches(missing, batch_size)
+            )))
+            await asyncio.to_thread(self._store_embeddings, missing, fresh)
+            embeddings.update(zip(uncached, fresh))
+        return self._assemble(len(texts), embeddings)
+
+    async def aiter_chunk_embeddings(
+        self,
+        texts: List[str],
+        window: int
+    ) -> AsyncIterator[Tuple[int, np.ndarray]]:
+        """
+        Embed a document's chunks, yielding each window of vectors as soon as it is ready.
+
+        Repeated headers, footers and boilerplate produce identical chunks;
+        each distinct text is embedded once and its vector fanned back out.
+        All embedding requests are submitted up front, so while the caller
+        handles one window the requests for later windows stay in flight.
 
+        Args:
+            texts: Chunk texts in document order
+            window: Number of chunks per yielded window
+
+        Yields:
+            (start, embeddings) pairs in document order, where embeddings is a
+            float32 array for texts[start:start + window]
+        """
+        positions: Dict[str, int] = {}
+        slots = [positions.setdefault(text, len(positions)) for text in texts]
+        unique_texts = list(positions)
+
+        uncached, vectors = await asyncio.to_thread(self.find_uncached_texts, unique_texts)
+        missing = [unique_texts[i] for i in uncached]
+        requests = deque(
+            (first, last, asyncio.create_task(self._aembed_request(missing[first:last])))
+            for first, last in _request_batches(missing, settings.EMBED_BATCH_SIZE)
+        )
+        try:
+            received = 0  # Leading uncached texts whose vectors are in hand
+            for start in range(0, len(texts), window):
+                window_slots = slots[start:start + window]
+                # Distinct texts are numbered by first appearance, so this
+                # window only needs the unique texts up to max(window_slots)
+                needed = bisect.bisect_right(uncached, max(window_slots))
+                while received < needed:
+                    first, last, request = requests.popleft()
+                    fresh = await request
+                    await asyncio.to_thread(self._store_embeddings, missing[first:last], fresh)
+                    vectors.update(zip(uncached[first:last], fresh))
+                    received = last
+                yield start, np.stack([vectors[slot] for slot in window_slots])
+        finally:
+            for _, _, request in requests:
+                request.cancel()
 
 embedding_service = EmbeddingService()
@@ -1,6 +1,5 @@
-from openai import OpenAI
-
 from config import settings
+from services.openai_client import async_openai_client
 
 
 class InterpreterService:
@@ -20,10 +19,16 @@ class InterpreterService:
     }
 
     def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.client = async_openai_client
         self.model = settings.CHAT_MODEL
+        # Every known tone/style pair, built once
+        self._system_prompts = {
+            (tone, style): self._build_system_prompt(tone, style)
+            for tone in self.TONES
+            for style in self.STYLES
+        }
 
-    def interpret(
+    async def ainterpret(
         self,
         user_input: str,
         tone: str = "insightful",
@@ -31,10 +36,10 @@ class InterpreterService:
         context: str | None = None
     ) -> dict:
         """Interpret user input with specified tone and style."""
-        system_prompt = self._build_system_prompt(tone, style)
+        system_prompt = self._system_prompts.get((tone, style)) or self._build_system_prompt(tone, style)
         user_prompt = self._build_user_prompt(user_input, context)
 
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": system_prompt},
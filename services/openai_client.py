@@ -0,0 +1,18 @@
+"""
+Shared async OpenAI client.
+"""
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from config import settings
+
+# One client per process so every service reuses the same pooled HTTP/2
+# connections instead of paying a TCP/TLS handshake per request.
+async_openai_client = AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100)
+    )
+)
@@ -1,8 +1,8 @@
-from typing import Dict, List
-from openai import OpenAI
-
+from typing import Dict, Optional
+import numpy as np
 from config import settings
 from services.embedding_service import embedding_service
+from services.openai_client import async_openai_client
 from services.vector_store_service import vector_store_service
 
 MAX_CITATION_LENGTH = 500
@@ -10,14 +10,18 @@ MAX_CITATION_LENGTH = 500
 
 class RAGService:
     def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.client = async_openai_client
         self.model = settings.CHAT_MODEL
     
     def _truncate_text(self, text: str, max_length: int = MAX_CITATION_LENGTH) -> str:
         """Truncate text to max_length, adding ellipsis if needed."""
         if len(text) <= max_length:
             return text
-        return text[:max_length - 3].rsplit(' ', 1)[0] + "..."
+        # Cut at the last space that leaves room for the ellipsis
+        cut = text.rfind(' ', 0, max_length - 3)
+        if cut == -1:
+            cut = max_length - 3
+        return text[:cut] + "..."
     
     def _distance_to_confidence(self, distance: float) -> float:
         """Convert cosine distance to confidence score (0-1)."""
@@ -26,13 +30,19 @@ class RAGService:
         confidence = 1 - (distance / 2)
         return round(max(0.0, min(1.0, confidence)), 2)
     
-    def answer_question(self, question: str, doc_id: str) -> Dict[str, any]:
+    async def aanswer_question(
+        self,
+        question: str,
+        doc_id: str,
+        question_embedding: Optional[np.ndarray] = None
+    ) -> Dict[str, any]:
         """
         Answer a question based on retrieved document chunks.
         
         Args:
             question: The user's question
             doc_id: The document UUID to search in
+            question_embedding: Precomputed embedding of the question, if available
             
         Returns:
             Dict with:
@@ -40,7 +50,8 @@ class RAGService:
             - citations: List of citation objects with text, page, confidence, chunk_id
         """
         # Generate embedding for the question
-        question_embedding = embedding_service.generate_embedding(question)
+        if question_embedding is None:
+            question_embedding = await embedding_service.agenerate_embedding(question)
         
         # Query vector store for relevant chunks
         results = vector_store_service.query_by_doc_id(
@@ -55,25 +66,24 @@ class RAGService:
                 "citations": []
             }
         
-        # Build citations with confidence scores
+        # Build citations with confidence scores and the context passages in one pass
         citations = []
+        passages = []
         for i, (doc, meta, distance) in enumerate(zip(
             results["documents"],
             results["metadatas"],
             results["distances"]
         )):
+            page = meta["page"]
             citations.append({
                 "text": self._truncate_text(doc),
-                "page": meta["page"],
+                "page": page,
                 "confidence": self._distance_to_confidence(distance),
                 "chunk_id": f"{doc_id}_chunk_{i}"
             })
+            passages.append(f"[Page {page}]\n{doc}")
         
-        # Build context string
-        context = "\n\n".join([
-            f"[Page {meta['page']}]\n{doc}"
-            for doc, meta in zip(results["documents"], results["metadatas"])
-        ])
+        context = "\n\n".join(passages)
         
         # Build prompt that forces strict context-based answers
         prompt = f"""You are a precise assistant that answers questions STRICTLY based on the provided context.
@@ -95,7 +105,7 @@ Question: {question}
 Provide a well-structured answer:"""
         
         # Call OpenAI Chat Completion
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that answers questions strictly based on provided context."},
@@ -0,0 +1,88 @@
+"""
+Semantic answer cache keyed by question embeddings.
+"""
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+
+from config import settings
+
+
+class _DocumentCache:
+    """Cached answers for a single document, in least- to most-recently-used order."""
+
+    __slots__ = ("entries", "keys", "matrix")
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, tuple[np.ndarray, Dict]]" = OrderedDict()
+        self.keys: List[int] = []
+        self.matrix: Optional[np.ndarray] = None
+
+    def stacked(self) -> tuple[List[int], np.ndarray]:
+        """Return entry keys and their vectors as one matrix, rebuilt only after inserts."""
+        if self.matrix is None:
+            self.keys = list(self.entries)
+            self.matrix = np.stack([self.entries[k][0] for k in self.keys])
+        return self.keys, self.matrix
+
+
+class SemanticCache:
+    """In-memory per-document answer cache matched by cosine similarity."""
+
+    def __init__(
+        self,
+        threshold: float = settings.SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = settings.SEMANTIC_CACHE_SIZE
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._docs: Dict[str, _DocumentCache] = {}
+        self._next_key = 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, doc_id: str, embedding: np.ndarray) -> Optional[Dict]:
+        """
+        Return a cached answer for a semantically equivalent question.
+
+        Args:
+            doc_id: The document the question is about
+            embedding: Embedding of the new question
+
+        Returns:
+            The cached result dict, or None if no entry is similar enough
+        """
+        cache = self._docs.get(doc_id)
+        if not cache or not cache.entries:
+            return None
+
+        keys, matrix = cache.stacked()
+        scores = matrix @ self._normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        key = keys[best]
+        cache.entries.move_to_end(key)
+        return cache.entries[key][1]
+
+    def store(self, doc_id: str, embedding: np.ndarray, result: Dict) -> None:
+        """Cache a result, evicting the least recently used entry when full."""
+        cache = self._docs.setdefault(doc_id, _DocumentCache())
+        cache.entries[self._next_key] = (self._normalize(embedding), result)
+        self._next_key += 1
+        if len(cache.entries) > self.max_entries:
+            cache.entries.popitem(last=False)
+        cache.matrix = None
+
+    def invalidate(self, doc_id: str) -> None:
+        """Drop all cached answers for a document."""
+        self._docs.pop(doc_id, None)
+
+
+semantic_cache = SemanticCache()
@@ -1,24 +1,48 @@
-from typing import List, Dict
+import threading
+from collections import Counter
+from operator import itemgetter
+from typing import List, Dict, Optional, Sequence
 import chromadb
+import numpy as np
 
 from config import settings
 
 
 class VectorStoreService:
     def __init__(self):
+        self.client = None
+        self._collection = None
+        # doc_id -> chunk count, built by one metadata scan on first use and
+        # then kept current by add_chunks / delete_document
+        self._chunk_counts: Optional[Dict[str, int]] = None
+        self._counts_lock = threading.Lock()
+    
+    def initialize(self) -> None:
+        """Open the persistent client and resolve the collection handle once."""
+        if self._collection is not None:
+            return
+        
         self.client = chromadb.PersistentClient(
             path=settings.CHROMA_PERSIST_DIR
         )
-        self.collection = self.client.get_or_create_collection(
+        self._collection = self.client.get_or_create_collection(
             name=settings.COLLECTION_NAME,
             metadata={"hnsw:space": "cosine"}
         )
     
+    @property
+    def collection(self):
+        """Cached collection handle, initialized on first use if startup did not."""
+        if self._collection is None:
+            self.initialize()
+        return self._collection
+    
     def add_chunks(
         self,
         doc_id: str,
         chunks: List[Dict[str, any]],
-        embeddings: List[List[float]]
+        embeddings: np.ndarray,
+        start: int = 0
     ):
         """
         Add document chunks with embeddings to ChromaDB.
@@ -26,38 +50,50 @@ class VectorStoreService:
         Args:
             doc_id: The document UUID
             chunks: List of chunk dicts with 'text' and 'page' keys
-            embeddings: List of embedding vectors
+            embeddings: float32 array with one embedding row per chunk
+            start: Position of chunks[0] in the document, for adding it in
+                consecutive slices
         """
-        ids = [f"{doc_id}_chunk_{i}" for i in range(len(chunks))]
-        documents = [chunk["text"] for chunk in chunks]
-        metadatas = [
-            {
-                "doc_id": doc_id,
-                "page": chunk["page"]
-            }
-            for chunk in chunks
-        ]
+        ids = [f"{doc_id}_chunk_{i}" for i in range(start, start + len(chunks))]
+        documents = list(map(itemgetter("text"), chunks))
+        metadatas = [{"doc_id": doc_id, "page": page} for page in map(itemgetter("page"), chunks)]
         
-        self.collection.add(
-            ids=ids,
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas
-        )
+        # Insert in bounded batches to keep each Chroma transaction small
+        batch_size = settings.CHROMA_BATCH_SIZE
+        for i in range(0, len(ids), batch_size):
+            end = i + batch_size
+            self.collection.add(
+                ids=ids[i:end],
+                embeddings=embeddings[i:end],
+                documents=documents[i:end],
+                metadatas=metadatas[i:end]
+            )
+        
+        # A document's slices are added in order, so its count is the end of
+        # the latest slice; unlike incrementing, this stays exact even if the
+        # first scan already saw these rows
+        with self._counts_lock:
+            if self._chunk_counts is not None:
+                self._chunk_counts[doc_id] = max(self._chunk_counts.get(doc_id, 0), start + len(ids))
     
     def query_by_doc_id(
         self,
-        query_embedding: List[float],
+        query_embedding: np.ndarray,
         doc_id: str,
-        top_k: int = 3
+        top_k: int = 3,
+        include: Sequence[str] = ("documents", "metadatas", "distances")
     ) -> Dict:
         """
         Query ChromaDB for relevant chunks filtered by doc_id.
+        
+        Fields left out of include are not serialized by Chroma and come
+        back as empty lists; omit "documents" when chunk text is not needed.
         """
         results = self.collection.query(
             query_embeddings=[query_embedding],
             n_results=top_k,
-            where={"doc_id": doc_id}
+            where={"doc_id": doc_id},
+            include=list(include)
         )
         
         return {
@@ -66,35 +102,56 @@ class VectorStoreService:
             "distances": results["distances"][0] if results["distances"] else []
         }
 
+    def _chunk_counts_locked(self) -> Dict[str, int]:
+        """The doc_id -> chunk count index, scanning Chroma once if needed. Hold _counts_lock."""
+        if self._chunk_counts is None:
+            results = self.collection.get(include=["metadatas"])
+            counts = Counter(meta.get("doc_id") for meta in results["metadatas"] or [])
+            counts.pop(None, None)
+            self._chunk_counts = dict(counts)
+        return self._chunk_counts
+
     def get_all_documents(self) -> List[Dict]:
         """Get all unique documents with their chunk counts."""
-        results = self.collection.get(include=["metadatas"])
-        
-        if not results["metadatas"]:
-            return []
-        
-        # Group by doc_id and count chunks
-        doc_map: Dict[str, Dict] = {}
-        for meta in results["metadatas"]:
-            doc_id = meta.get("doc_id")
-            if doc_id:
-                if doc_id not in doc_map:
-                    doc_map[doc_id] = {"doc_id": doc_id, "chunks": 0}
-                doc_map[doc_id]["chunks"] += 1
-        
-        return list(doc_map.values())
+        with self._counts_lock:
+            return [
+                {"doc_id": doc_id, "chunks": chunks}
+                for doc_id, chunks in self._chunk_counts_locked().items()
+            ]
 
     def document_exists(self, doc_id: str) -> bool:
         """Check if a document exists in the collection."""
-        results = self.collection.get(
+        with self._counts_lock:
+            return doc_id in self._chunk_counts_locked()
+
+    def warm_doc(self, doc_id: str) -> None:
+        """
+        Run a minimal query against a document so its index pages are cached.
+        
+        Uses one of the document's own vectors as the probe, so no embedding
+        call is needed.
+        """
+        sample = self.collection.get(
+            where={"doc_id": doc_id},
+            limit=1,
+            include=["embeddings"]
+        )
+        if len(sample["ids"]) == 0:
+            return
+        
+        self.collection.query(
+            query_embeddings=sample["embeddings"],
+            n_results=1,
             where={"doc_id": doc_id},
-            limit=1
+            include=["distances"]
         )
-        return len(results["ids"]) > 0
 
     def delete_document(self, doc_id: str) -> None:
         """Delete all chunks for a document."""
         self.collection.delete(where={"doc_id": doc_id})
+        with self._counts_lock:
+            if self._chunk_counts is not None:
+                self._chunk_counts.pop(doc_id, None)
 
 
 vector_store_service = VectorStoreService()